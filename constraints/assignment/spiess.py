@@ -11,9 +11,73 @@ Transit Networks. Transportation Research Part B: Methodological,
 
 # Note: This import path assumes that this module is being called from within
 # the main driver module.
+import collections
 import constraints.assignment.spiess_constant as sc
 import numpy as np
-import scipy.optimize as op
+
+# Numba is optional; without it the objective kernel falls back to NumPy
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+#==============================================================================
+def _fused_obj_numpy(parameter, flows, flow_new, base, arc_cap, alpha, beta,
+                     waiting_delta):
+    """Nonlinear cost objective first and second derivatives (NumPy version).
+
+    Evaluates the first and second derivatives of the nonlinear cost model's
+    objective with respect to the convex combination parameter. Both share the
+    same convex combination of flows and the same square root term of the
+    conical arc cost function, so they are derived from one set of
+    intermediate arrays.
+
+    Requires, in order: the convex combination parameter, the current flow
+    vector, the new flow vector, the arc base cost vector, the arc capacity
+    vector, the two conical congestion parameters, and the difference between
+    the new and current waiting times.
+
+    Returns a tuple of the first and second derivatives, respectively.
+    """
+
+    delta = flow_new - flows
+    ratio = 1 - (flows + parameter*delta)/arc_cap
+    root = np.hypot(alpha*ratio, beta)
+
+    cost = base*(2 + root - alpha*ratio - beta)
+    cost_prime = base*(alpha - ratio*(alpha*alpha)/root)/arc_cap
+
+    return (waiting_delta + np.sum(delta*cost),
+            np.sum(delta*delta*cost_prime))
+
+#==============================================================================
+def _fused_obj_loop(parameter, flows, flow_new, base, arc_cap, alpha, beta,
+                    waiting_delta):
+    """Nonlinear cost objective first and second derivatives (Numba version).
+
+    Computes the same values as the NumPy version, but as a single (parallel)
+    pass over the arcs that accumulates both sums directly, without creating
+    any intermediate arrays. Meant to be compiled with Numba.
+    """
+
+    fprime = waiting_delta
+    fprime2 = 0.0
+    for i in nb.prange(flows.shape[0]):
+        delta = flow_new[i] - flows[i]
+        ratio = 1 - (flows[i] + parameter*delta)/arc_cap[i]
+        root = np.hypot(alpha*ratio, beta)
+        fprime += delta*base[i]*(2 + root - alpha*ratio - beta)
+        fprime2 += (delta*delta*base[i]*(alpha - ratio*(alpha*alpha)/root)
+                    /arc_cap[i])
+
+    return fprime, fprime2
+
+# Choose the objective kernel depending on whether Numba is available
+if nb is None:
+    _fused_obj = _fused_obj_numpy
+else:
+    _fused_obj = nb.njit(parallel=True, fastmath=True, cache=True,
+                         error_model='numpy')(_fused_obj_loop)
 
 #==============================================================================
 class Spiess:
@@ -46,12 +110,14 @@ class Spiess:
             optimality_epsilon -- Epsilon value for the Frank-Wolfe solution
                 solution algorithm of the nonlinear cost model. The algorithm
                 terminates as soon as the absolute optimality gap falls below
-                this value (or upon reaching the iteration cutoff). Defaults to
-                0.1.
+                this value (or upon reaching the iteration cutoff, or upon
+                one of the early termination conditions described in
+                calculate()). Defaults to 0.1.
             max_iterations -- Maximum number of iterations of the Frank-Wolfe
                 solution algorithm. The algorithm cuts off at this point if it
-                has not yet achieved the desired optimality gap. Defaults to
-                100.
+                has not yet achieved the desired optimality gap (unless it
+                has already terminated early, as described in calculate()).
+                Defaults to 100.
         """
 
         ##################################################################################
@@ -72,12 +138,6 @@ class Spiess:
         # Read in rest of problem data
         self._load_data()
 
-    #--------------------------------------------------------------------------
-    def __del__(self):
-        """Nonlinear Spiess object destructor. Deletes the submodel object."""
-
-        del self.Submodel
-
     #--------------------------------------------------------------------------
     def _load_data(self):
         """Reads model and line information from the data files.
@@ -88,120 +148,136 @@ class Spiess:
         object.
         """
 
-        # Read in conical congestion parameter
+        # Read in conical congestion parameter (twelfth line of the file)
         with open(self.data+"Problem_Data.txt", 'r') as f:
-            for i in range(11):
-                # Skip first few lines
-                f.readline()
-            self.conical_alpha = float(f.readline())
+            lines = f.read().splitlines()
+        self.conical_alpha = float(lines[11])
 
         # Calculate second conical congestion parameter
         self.conical_beta = (2*self.conical_alpha-1)/(2*self.conical_alpha-2)
 
-        # Initialize line capacity list
-        self.capacity = []
-        i = -1
-        with open(self.data+"Transitdata.txt", 'r') as f:
-            for line in f:
-                i += 1
-                if i > 0:
-                    # Skip comment line
-                    self.capacity.append(float(line.split()[2]))
+        # Initialize line capacity vector (third column, skip comment line)
+        self.capacity = np.loadtxt(self.data+"Transitdata.txt", usecols=(2,),
+                                   skiprows=1, dtype=np.float64, ndmin=1)
 
-    #--------------------------------------------------------------------------
-    def _arc_cost(self, base, flow, capacity):
-        """Nonlinear arc cost function.
-
-        This is a conical congestion function for the line arc costs. It should
-        cause the cost of a line arc to sharply increase as it approaches its
-        capacity, discouraging too many people from using the same line and
-        helping to enforce line capacity.
+        # Arc base costs and line indices as parallel arrays (in the order of
+        # the arc list), so that no arc objects are visited while solving
+        arcs = self.Submodel.arcs
+        self._arc_base = np.fromiter((a.cost for a in arcs), dtype=np.float64,
+                                     count=len(arcs))
+        self._arc_line = np.fromiter((a.line for a in arcs), dtype=np.intp,
+                                     count=len(arcs))
 
-        Requires, in order: the line's base cost, the current arc flow, and the
-        line capacity.
-        """
+        # Capacity of each arc's line (refreshed whenever capacities change)
+        self._set_arc_capacity(self.capacity)
 
-        ratio = 1 - flow/capacity
+        # Reusable buffers for the arc cost vector passed to the Submodel and
+        # for the intermediate terms used to calculate it
+        self._cost_buf = np.empty(len(arcs), dtype=np.float64)
+        self._ratio_buf = np.empty(len(arcs), dtype=np.float64)
+        self._sqrt_buf = np.empty(len(arcs), dtype=np.float64)
 
-        return base*(2 + np.sqrt((self.conical_alpha*ratio)**2
-                                 + self.conical_beta**2) - self.conical_alpha
-                                 *ratio - self.conical_beta)
+        # Recent Submodel solutions, keyed on the hash of their cost vectors
+        self._solve_cache = collections.OrderedDict()
+        self._solve_cache_size = 8
 
     #--------------------------------------------------------------------------
-    def _arc_cost_prime(self, base, flow, capacity):
-        """Derivative of the arc cost function (with respect to flow).
+    def _set_arc_capacity(self, cap):
+        """Gathers a line capacity vector into the arc capacity vector.
 
-        This derivative is used in the process of finding the optimal convex
-        combination of the old and new solutions. Specifically, it is used to
-        apply a derivative-based root finding method to annulling the
-        objective's derivative.
+        Every arc uses its line's capacity, so the line capacities are copied
+        onto the arcs once whenever they change. The result is stored as a
+        single contiguous array so that the objective evaluations can stream
+        through it directly without any indirect indexing.
         """
 
-        ratio = 1 - flow/capacity
-
-        return base*(-(ratio*(self.conical_alpha**2))/(capacity*np.sqrt((ratio*
-                self.conical_alpha)**2 + self.conical_beta**2)) +
-                self.conical_alpha/capacity)
+        self._arc_cap = np.ascontiguousarray(np.asarray(cap, dtype=np.float64)
+                                             [self._arc_line])
 
     #--------------------------------------------------------------------------
-    def _obj_prime(self, parameter, flow_new, wait_new):
-        """Nonlinear cost objective first derivative (w.r.t. convex parameter).
+    def _obj_values(self, parameter, flow_new, wait_new):
+        """Nonlinear cost objective derivatives (w.r.t. convex parameter).
 
-        This is the first derivative of the nonlinear cost model's objective
-        (with respect to the convex combination parameter) evaluated at a
-        convex combination of the current solution and a new solution . Our
-        method for finding the optimal convex combination is to find the root
-        of this derivative.
+        These are the first and second derivatives of the nonlinear cost
+        model's objective (with respect to the convex combination parameter)
+        evaluated at a convex combination of the current solution and a new
+        solution. Our method for finding the optimal convex combination is to
+        find the root of the first derivative. Both are computed together in a
+        single pass over the arcs and returned as a tuple.
 
         The inputs, in order, are: the convex combination parameter, the new
         flow vector, and the new waiting time. Only the convex combination will
         be treated as a variable by the root finder.
         """
 
-        t = wait_new - self.waiting
-        for i in range(len(self.Submodel.arcs)):
-            a = self.Submodel.arcs[i]
-            t += (flow_new[i]-self.flows[i])*self._arc_cost(a.cost,
-                   (1-parameter)*self.flows[i]+parameter*flow_new[i],
-                   self.capacity[a.line])
-        return t
+        return _fused_obj(parameter, self.flows, flow_new, self._arc_base,
+                          self._arc_cap, self.conical_alpha, self.conical_beta,
+                          wait_new - self.waiting)
 
     #--------------------------------------------------------------------------
-    def _obj_prime2(self, parameter, flow_new, wait_new):
-        """Nonlinear cost objective second derivative.
+    def _update_arc_costs(self):
+        """Updates all arc costs based on the current flows.
+
+        The nonlinear arc cost function is a conical congestion function for
+        the line arc costs. It should cause the cost of a line arc to sharply
+        increase as it approaches its capacity, discouraging too many people
+        from using the same line and helping to enforce line capacity. For an
+        arc with base cost c, flow x, and line capacity u, it is:
+
+            c*(2 + sqrt((alpha*r)^2 + beta^2) - alpha*r - beta),  r = 1 - x/u
 
-        Analogous to the first derivative function, but now the second
-        derivative with respect to the convex combination parameter. Used by
-        a derivative-based root finding method to find the root of the first
-        derivative.
+        This is evaluated over the whole arc array at once, with every
+        intermediate result written into a preallocated buffer so that no new
+        arrays are created. The results are left in the cost buffer and are
+        passed to the Submodel when it is next solved.
         """
 
-        t = 0.0
-        for i in range(len(self.Submodel.arcs)):
-            a = self.Submodel.arcs[i]
-            t += ((flow_new[i]-self.flows[i])**2)*self._arc_cost_prime(a.cost,
-                 (1-parameter)*self.flows[i]+parameter*flow_new[i],
-                 self.capacity[a.line])
-        return t
+        ratio = self._ratio_buf
+        root = self._sqrt_buf
+        cost = self._cost_buf
+
+        # alpha*r
+        np.divide(self.flows, self._arc_cap, out=ratio)
+        np.subtract(1.0, ratio, out=ratio)
+        np.multiply(self.conical_alpha, ratio, out=ratio)
+
+        # c*(2 + sqrt((alpha*r)^2 + beta^2) - alpha*r - beta)
+        np.hypot(ratio, self.conical_beta, out=root)
+        np.subtract(root, ratio, out=cost)
+        np.add(cost, 2 - self.conical_beta, out=cost)
+        np.multiply(self._arc_base, cost, out=cost)
 
     #--------------------------------------------------------------------------
-    def _update_arc_costs(self):
-        """Updates all arc costs in the Submodel based on the current flows.
+    def _solve_submodel(self):
+        """Solves the Submodel for the current arc costs.
+
+        Near convergence the arc costs tend to repeat, so the most recent
+        solutions are cached by the hash of their cost vectors. If the current
+        cost vector matches a cached one exactly, then its solution is returned
+        without solving the LP again. Otherwise the costs are passed to the
+        Submodel to update its LP, which is then solved.
 
-        This process involves going through each arc, using the arc cost
-        function to calculate its cost, and then passing the vector of results
-        to the Submodel to update its LP.
+        The output has the same form as the Submodel's calculate() method.
         """
 
-        cost = [0.0 for a in self.Submodel.arcs] # initialize new cost vector
+        # Look for a cached solution with an identical cost vector
+        key = hash(self._cost_buf.tobytes())
+        if key in self._solve_cache:
+            cost, flows, waiting = self._solve_cache[key]
+            if np.array_equal(cost, self._cost_buf):
+                self._solve_cache.move_to_end(key)
+                return flows, waiting
 
-        for i in range(len(self.Submodel.arcs)):
-            # Calculate cost of each arc one-at-a-time
-            a = self.Submodel.arcs[i]
-            cost[i] = self._arc_cost(a.cost, self.flows[i],
-                self.capacity[a.line])
+        # Pass new cost vector to Submodel and solve
+        self.Submodel.update_cost(self._cost_buf)
+        flows, waiting = self.Submodel.calculate()
 
-        self.Submodel.update_cost(cost) # pass new cost vector to Submodel
+        # Cache the solution, discarding the least recently used
+        self._solve_cache[key] = (self._cost_buf.copy(), flows, waiting)
+        if len(self._solve_cache) > self._solve_cache_size:
+            self._solve_cache.popitem(last=False)
+
+        return flows, waiting
 
     #--------------------------------------------------------------------------
     def update_lines(self, freq, cap):
@@ -220,6 +296,8 @@ class Spiess:
 
         self.Submodel.update_lines(freq) # update submodel
         self.capacity = cap # update own capacities
+        self._set_arc_capacity(cap)
+        self._solve_cache.clear() # cached solutions used old frequencies
 
     #--------------------------------------------------------------------------
     def _optimal_step(self, flow_new, wait_new):
@@ -230,45 +308,79 @@ class Spiess:
         'Optimal' here means that it minimizes the objective value of the
         nonlinear cost Spiess and Florian model.
 
+        The optimality gap of the current solution is also returned. This is
+        an upper bound for the absolute optimality gap, for use in deciding
+        when to terminate the Frank-Wolfe algorithm. It is the negative of the
+        objective derivative at parameter 0, which is already evaluated while
+        bracketing the root, so it comes at no extra cost.
+
         The objective is convex, so we need only search for the root of its
-        derivative with respect to the convex combination parameter. If this
-        occurs for a parameter value outside of [0,1], then the optimum occurs
-        at an endpoint of the interval, in which case we just take the endpoint
-        closer to the root.
+        derivative with respect to the convex combination parameter. This
+        derivative is nondecreasing, so we first evaluate it at both endpoints
+        of [0,1]. If it does not change sign over the interval, then the
+        optimum occurs at the endpoint closer to the root. Otherwise the root
+        is bracketed and can be found with a safeguarded Newton's method. This
+        starts from the previous iteration's parameter, since successive step
+        sizes tend to be close, and shrinks the bracket after every step. Any
+        Newton step that would leave the bracket is replaced by a bisection
+        step, so the search can never leave the interval.
 
         In case the root finding process fails to converge, we will default to
         a method of successive averages convex combination (1/n new and 1-1/n
         old for iteration n).
         """
 
-        # Attempt to annul the objective derivative w.r.t. the convex param
-        root_sol = op.root_scalar(self._obj_prime, (flow_new, wait_new),
-                                  method='newton', x0=1.0,
-                                  fprime=self._obj_prime2)
+        # Share objective evaluations between all stages of the search
+        memo = _MemoFG(self._obj_values, flow_new, wait_new)
+
+        # Evaluate the objective derivative at the interval endpoints
+        g0 = memo.f(0.0)
+        g1 = memo.f(1.0)
 
         # Choose convex combination parameter
-        if root_sol.converged == True:
-            # Take final parameter value, restricted to [0,1]
-            parameter = max(0.0, min(1.0, root_sol.root))
+        if g0 >= 0:
+            # Objective nondecreasing over the whole interval
+            parameter = 0.0
+        elif g1 <= 0:
+            # Objective nonincreasing over the whole interval
+            parameter = 1.0
         else:
-            # Default to MSA parameter
-            parameter = 1/self.iteration
-
-        # Return convex combination
+            # Annul the objective derivative w.r.t. the convex param, starting
+            # from the previous iteration's parameter and keeping the root
+            # bracketed in [lo,hi] throughout
+            lo, hi = 0.0, 1.0
+            p = self._last_param
+            parameter = 1/self.iteration # MSA parameter if no convergence
+            for i in range(50):
+                g = memo.f(p)
+                if g == 0:
+                    # Exact root
+                    parameter = p
+                    break
+
+                # Shrink the bracket to the side of p containing the root
+                if g > 0:
+                    hi = p
+                else:
+                    lo = p
+
+                # Take a Newton step, or bisect if it would leave the bracket
+                gp = memo.fprime(p)
+                if gp > 0 and lo < p - g/gp < hi:
+                    p_next = p - g/gp
+                else:
+                    p_next = (lo + hi)/2
+
+                if abs(p_next - p) < 1e-6 or hi - lo < 1e-6:
+                    parameter = p_next
+                    break
+                p = p_next
+
+        self._last_param = parameter
+
+        # Return convex combination and optimality gap
         return ((1-parameter)*self.flows + parameter*flow_new,
-                (1-parameter)*self.waiting + parameter*wait_new)
-
-    #--------------------------------------------------------------------------
-    def _optimality_gap(self, flow_new, wait_new):
-        """Returns the optimality gap given the updated flow and waiting time.
-
-        This is an upper bound for the absolute optimality gap, for use in
-        deciding when to terminate the Frank-Wolfe algorithm. It should be
-        evaluated before setting the updated solutions as current, since it
-        relies on evaluating differences between the two.
-        """
-
-        return -self._obj_prime(0, flow_new, wait_new)
+                (1-parameter)*self.waiting + parameter*wait_new, -g0)
 
     #--------------------------------------------------------------------------
     def calculate(self):
@@ -303,6 +415,12 @@ class Spiess:
                 terminate and output the current solution. Otherwise, return to
                 Step 1.
 
+        The algorithm also terminates early if the constant-cost model returns
+        the current solution (which is then optimal), or if the optimality gap
+        decreases, but by a negligible amount, for two consecutive iterations.
+        Increases in the gap do not count towards this, since the Frank-Wolfe
+        gap is not monotone.
+
         The output is a tuple consisting of a NumPy array of total arc flows
         (in the order of the arc list) and the total waiting time (as a
         scalar), respectively.
@@ -310,11 +428,16 @@ class Spiess:
 
         # Initialize solution vector
         self._update_arc_costs()
-        self.flows, self.waiting = self.Submodel.calculate()
+        self.flows, self.waiting = self._solve_submodel()
 
         self.iteration = 0
+        self._last_param = 1.0 # previous optimal step parameter
         gap = np.inf
 
+        # Stagnation state
+        prev_gap = np.inf # previous optimality gap
+        stalls = 0 # consecutive iterations with negligible gap progress
+
         # Main loop
         while (gap > self.epsilon) and (self.iteration < self.max_iterations):
             # Continue until achieving a small enough optimality gap or
@@ -324,13 +447,76 @@ class Spiess:
 
             # Update costs and solve constant-cost model
             self._update_arc_costs()
-            cc_flows, cc_waiting = self.Submodel.calculate()
-
-            # Find optimal convex combination
-            new_flows, new_waiting = self._optimal_step(cc_flows, cc_waiting)
-
-            # Calculate optimality gap and move to new solution
-            gap = self._optimality_gap(cc_flows, cc_waiting)
+            cc_flows, cc_waiting = self._solve_submodel()
+
+            if (np.allclose(cc_flows, self.flows, rtol=1e-9) and
+                np.isclose(cc_waiting, self.waiting, rtol=1e-9)):
+                # Constant-cost model returned the current solution, which is
+                # therefore already optimal (the current solution is always a
+                # convex combination of feasible solutions, so it is feasible)
+                break
+
+            # Find optimal convex combination and optimality gap
+            new_flows, new_waiting, gap = self._optimal_step(cc_flows,
+                                                             cc_waiting)
+
+            # Stop if the gap has barely decreased for two iterations in a row
+            # (an increase in the gap does not count as stagnation)
+            if 0 <= prev_gap - gap < 1e-4*max(1, prev_gap):
+                stalls += 1
+            else:
+                stalls = 0
+            prev_gap = gap
+
+            # Move to new solution
             self.flows, self.waiting = new_flows, new_waiting
+            if stalls >= 2:
+                break
 
         return self.flows, self.waiting
+
+#==============================================================================
+class _MemoFG:
+    """A class for caching objective evaluations during one step search.
+
+    The optimal step search evaluates the objective derivative at the interval
+    endpoints before starting the root finder, which often starts from one of
+    those same points, and Newton's method needs both the first and second
+    derivatives at each point. This wrapper remembers every evaluation made
+    for a single new solution so that each parameter value is only ever
+    evaluated once, and so that both derivatives share a single evaluation.
+    """
+
+    #--------------------------------------------------------------------------
+    def __init__(self, fun, *args):
+        """Memoizing wrapper constructor.
+
+        Requires the function to wrap, which should accept the convex
+        combination parameter followed by the given fixed arguments and return
+        a (first derivative, second derivative) tuple.
+        """
+
+        self.fun = fun
+        self.args = args
+        self.values = {} # evaluated (f, f') tuples indexed by parameter
+
+    #--------------------------------------------------------------------------
+    def _evaluate(self, parameter):
+        """Returns the wrapped function's output, evaluating it if needed."""
+
+        parameter = float(parameter)
+        if parameter not in self.values:
+            self.values[parameter] = self.fun(parameter, *self.args)
+        return self.values[parameter]
+
+    #--------------------------------------------------------------------------
+    def f(self, parameter):
+        """Returns the objective first derivative at the given parameter."""
+
+        return self._evaluate(parameter)[0]
+
+    #--------------------------------------------------------------------------
+    def fprime(self, parameter):
+        """Returns the objective second derivative at the given parameter."""
+
+        return self._evaluate(parameter)[1]
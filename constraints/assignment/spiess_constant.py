@@ -204,9 +204,11 @@ class SpiessConstant:
         # Set LP as minimization
         self.lp.objective.set_sense(self.lp.objective.sense.minimize)
 
-        # Variable names
+        # Variable names (kept for reading and updating variables in bulk)
         flow_vars = [self._var_name(a.index, flow=True) for a in self.arcs]
         wait_vars = [self._var_name(n.index, flow=False) for n in self.stops]
+        self._flow_vars = flow_vars
+        self._wait_vars = wait_vars
 
         # Objective coefficients are travel times for flows and 1 for waits
         flow_obj = [a.cost for a in self.arcs]
@@ -222,8 +224,9 @@ class SpiessConstant:
         self.lp.variables.add(names=flow_vars+wait_vars, obj=flow_obj+wait_obj,
                               lb=flow_lb+wait_lb, ub=flow_ub+wait_ub)
 
-        # Constraint names
+        # Constraint names (flow conservation names kept for RHS resets)
         flow_con = [self._con_name(n.index) for n in self.nodes]
+        self._flow_cons = flow_con
         wait_con = []
         for n in self.stops:
             wait_con += [self._con_name(n.index, a) for a in n.out_arcs]
@@ -347,21 +350,19 @@ class SpiessConstant:
         self.lp.cleanup(self.epsilon) # clean up solver leftovers
         self.lp.solve() # have CPLEX solve the LP
 
-        # Read results from the CPLEX solution
-        for a in self.arcs:
+        # Read results from the CPLEX solution (one call per variable type)
+        flows = self.lp.solution.get_values(self._flow_vars)
+        waits = self.lp.solution.get_values(self._wait_vars)
+        for a, flow in zip(self.arcs, flows):
             if add == False:
-                a.flow = self.lp.solution.get_values(self._var_name(a.index,
-                      flow=True))
+                a.flow = flow
             else:
-                a.flow += self.lp.solution.get_values(self._var_name(a.index,
-                      flow=True))
-        for n in self.stops:
+                a.flow += flow
+        for n, wait in zip(self.stops, waits):
             if add == False:
-                n.wait = self.lp.solution.get_values(self._var_name(n.index,
-                      flow=False))
+                n.wait = wait
             else:
-                n.wait += self.lp.solution.get_values(self._var_name(n.index,
-                      flow=False))
+                n.wait += wait
 
     #--------------------------------------------------------------------------
     def _set_destination(self, dest):
@@ -372,8 +373,8 @@ class SpiessConstant:
         """
 
         # The Cplex RHS reset requires a list of (name,value) tuples
-        new_rhs = [(self._con_name(self.nodes[i].index), self.od[i][dest]) for
-                   i in range(len(self.nodes))]
+        new_rhs = [(con, demand[dest]) for con, demand in
+                   zip(self._flow_cons, self.od)]
         self.lp.linear_constraints.set_rhs(new_rhs)
 
     #--------------------------------------------------------------------------
@@ -407,11 +408,15 @@ class SpiessConstant:
         involves iteratively solving and re-solving the fixed-cost version with
         different cost vectors. The update process requires changing the flow
         variable coefficients in the objective.
+
+        The cost vector should be a NumPy array (in the order of the arc list),
+        although any sequence of numbers is accepted.
         """
 
-        # The Cplex coefficient reset requires a list of (var,value) tuples
-        new_coef = [(self._var_name(self.arcs[i].index, flow=True), cost[i])
-                    for i in range(len(cost))]
+        # The Cplex coefficient reset requires a list of (var,value) tuples,
+        # so convert the costs to Python floats in a single pass
+        cost = np.asarray(cost, dtype=float).tolist()
+        new_coef = list(zip(self._flow_vars, cost))
         self.lp.objective.set_linear(new_coef)
 
     #--------------------------------------------------------------------------
@@ -437,12 +442,11 @@ class SpiessConstant:
                 self._cplex_solve(add=True)
 
         # Total waiting time
-        tot_wait = 0.0
-        for n in self.nodes:
-            tot_wait += n.wait
+        tot_wait = sum(n.wait for n in self.nodes)
 
         # Return flows followed by waiting time
-        return np.array([a.flow for a in self.arcs], dtype=float), tot_wait
+        return (np.fromiter((a.flow for a in self.arcs), dtype=float,
+                            count=len(self.arcs)), float(tot_wait))
 
 #==============================================================================
 class _Node: